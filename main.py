@@ -1,10 +1,29 @@
 import asyncio
+import bisect
+import contextlib
+import functools
+import itertools
+import json
+import logging
+import os
+import re
+import sys
 import tempfile
+import uuid
+from collections.abc import Sequence
 from pathlib import Path
 
+import pygls.io_
+import pygls.protocol.json_rpc
 from lsprotocol import types
+from pygls.io_ import run_async
 from pygls.lsp.client import LanguageClient
 
+try:
+    import orjson
+except ImportError:  # optional; pygls keeps using the stdlib json module
+    orjson = None
+
 SAMPLE_CODE = """\
 class Greeter
   def greet
@@ -40,54 +59,259 @@ require \"foo/ba\"
 REQUEST_TIMEOUT = 10.0
 INIT_TIMEOUT = 60.0
 
+SERVER_COMMAND = ("crystal", "run", "-Dpreview_mt", "-Dexecution_context", "src/bin/cra.cr")
+# CRA_TRANSPORT=pipe talks to the server over a Unix domain socket instead of stdio.
+TRANSPORT = os.environ.get("CRA_TRANSPORT", "stdio")
+# CRA_POOL_SIZE=N spreads the completion probes over N server processes.
+# Validated by ClientPool.
+POOL_SIZE = os.environ.get("CRA_POOL_SIZE", "1")
+
+PYGLS_LOGGER = logging.getLogger("pygls.client")
+
+IDENTIFIER_TAIL = re.compile(r"[A-Za-z_@/][\w@/]*$")
+
+
+class _OrjsonCodec:
+    """Drop-in for the ``json`` module as pygls uses it, backed by orjson."""
+
+    @staticmethod
+    def loads(data, object_hook=None):
+        message = orjson.loads(data)
+        # pygls's hook only structures the top-level JSON-RPC envelope; nested
+        # objects pass through it unchanged.
+        if object_hook is not None and isinstance(message, dict):
+            return object_hook(message)
+        return message
+
+    @staticmethod
+    def dumps(data, default=None) -> str:
+        body = orjson.dumps(data, default=default)
+        # pygls sets Content-Length from len(str), which is only the byte count
+        # for ASCII, so let json escape anything else.
+        if body.isascii():
+            return body.decode()
+        return json.dumps(data, default=default)
+
+
+def use_orjson() -> None:
+    if orjson is None:
+        return
+    pygls.io_.json = _OrjsonCodec
+    pygls.protocol.json_rpc.json = _OrjsonCodec
+
+
+_log_queue: asyncio.Queue[str] | None = None
+
 
 def log(message: str) -> None:
-    print(message, flush=True)
+    # While log_flusher() is active, messages are batched so a burst of stderr
+    # lines costs one write instead of one per line.
+    if _log_queue is None:
+        print(message, flush=True)
+        return
+    _log_queue.put_nowait(message)
+
+
+def _write_logs(queue: asyncio.Queue[str], batch: list[str]) -> None:
+    while not queue.empty():
+        batch.append(queue.get_nowait())
+    if batch:
+        sys.stdout.write("\n".join(batch) + "\n")
+        sys.stdout.flush()
+
+
+@contextlib.asynccontextmanager
+async def log_flusher():
+    global _log_queue
+    queue: asyncio.Queue[str] = asyncio.Queue()
+
+    async def _flush() -> None:
+        while True:
+            _write_logs(queue, [await queue.get()])
+
+    flusher = asyncio.create_task(_flush())
+    _log_queue = queue
+    try:
+        yield
+    finally:
+        _log_queue = None
+        flusher.cancel()
+        try:
+            await flusher
+        except asyncio.CancelledError:
+            pass
+        _write_logs(queue, [])
+
+
+@functools.lru_cache(maxsize=8)
+def _newline_offsets(text: str) -> list[int]:
+    return [i for i, ch in enumerate(text) if ch == "\n"]
 
 
 def position_for(text: str, needle: str, offset: int = 0, occurrence: int = 0) -> types.Position:
-    idx = -1
-    for _ in range(occurrence + 1):
-        idx = text.index(needle, idx + 1)
-    idx += offset
-    line = text.count("\n", 0, idx)
-    last_nl = text.rfind("\n", 0, idx)
-    col = idx - (last_nl + 1 if last_nl != -1 else 0)
+    # A lookahead keeps overlapping occurrences, as repeated str.index() did.
+    matches = re.finditer(f"(?={re.escape(needle)})", text)
+    match = next(itertools.islice(matches, occurrence, None), None)
+    if match is None:
+        raise ValueError(f"occurrence {occurrence} of {needle!r} not found")
+    idx = match.start() + offset
+    newlines = _newline_offsets(text)
+    line = bisect.bisect_left(newlines, idx)
+    last_nl = newlines[line - 1] if line else -1
+    col = idx - last_nl - 1
     return types.Position(line=line, character=col)
 
 
+POSITIONS = {
+    "method": position_for(SAMPLE_CODE, "greeter.gr", offset=len("greeter.gr")),
+    "ivar": position_for(SAMPLE_CODE, "@ba", offset=len("@ba")),
+    "keyword": position_for(SAMPLE_CODE, "ret", offset=len("ret")),
+    "require": position_for(SAMPLE_CODE, "foo/ba", offset=len("foo/ba")),
+}
+
+# (name, trigger character, labels the completion should contain)
+PROBES = [
+    ("method", ".", ["greet", "grab"]),
+    ("ivar", "@", ["@bar", "@baz"]),
+    ("keyword", None, ["return"]),
+    ("require", None, ["foo/bar", "foo/baz"]),
+]
+
+
+async def drain_stderr(server_proc: asyncio.subprocess.Process) -> None:
+    def _report(line: bytes) -> None:
+        if b"ERROR" in line or b"Error" in line or b"error" in line:
+            log(f"[server stderr] {line.decode(errors='replace').rstrip()}")
+
+    if server_proc.stderr is None:
+        return
+    pending = b""
+    while chunk := await server_proc.stderr.read(65536):
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            _report(line)
+    _report(pending)
+
+
+async def start_pipe(client: LanguageClient, sock_path: str) -> None:
+    server_proc = await asyncio.create_subprocess_exec(
+        *SERVER_COMMAND,
+        "--",
+        "--pipe",
+        sock_path,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    # Registered before the socket exists so stop_client cleans up after a
+    # failed start, and so errors from a server that never listens are shown.
+    client._server = server_proc
+    stderr_drain = asyncio.create_task(drain_stderr(server_proc))
+    client._async_tasks.append(stderr_drain)
+    # `crystal run` compiles first, so the socket shows up some time after spawn.
+    async with asyncio.timeout(INIT_TIMEOUT):
+        while True:
+            if server_proc.returncode is not None:
+                await asyncio.wait({stderr_drain}, timeout=1.0)
+                raise RuntimeError(f"server exited with code {server_proc.returncode} before listening")
+            try:
+                reader, writer = await asyncio.open_unix_connection(sock_path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+
+    async def _serve() -> None:
+        try:
+            await run_async(
+                stop_event=client._stop_event,
+                reader=reader,
+                protocol=client.protocol,
+                logger=PYGLS_LOGGER,
+                error_handler=client.report_server_error,
+            )
+        finally:
+            writer.close()
+            await _settle(writer.wait_closed())
+
+    # Same wiring as LanguageClient.start_io, including the exit watcher that
+    # fails pending requests when the server dies.
+    client.protocol.set_writer(writer)
+    client._async_tasks.extend(
+        [asyncio.create_task(_serve()), asyncio.create_task(client._server_exit())]
+    )
+
+
+async def start_server(client: LanguageClient, index: int = 0) -> None:
+    if TRANSPORT == "pipe":
+        await start_pipe(client, str(Path(tempfile.gettempdir()) / f"cra-{os.getpid()}-{index}.sock"))
+    else:
+        await client.start_io(*SERVER_COMMAND)
+        client._async_tasks.append(asyncio.create_task(drain_stderr(client._server)))
+
+
+class ClientPool:
+    """Several server processes that take the harness's requests in turn."""
+
+    def __init__(self, size: int | str) -> None:
+        # Also takes the raw CRA_POOL_SIZE string, so bad input of either kind
+        # fails here with the same message.
+        try:
+            count = int(size)
+        except ValueError:
+            count = 0
+        if count < 1:
+            raise ValueError(f"pool size must be at least 1, got {size!r} (see CRA_POOL_SIZE)")
+        self.clients = [LanguageClient("cr-analyzer", "v1") for _ in range(count)]
+        self._next = itertools.cycle(self.clients)
+
+    async def start(self) -> None:
+        await asyncio.gather(*(start_server(client, i) for i, client in enumerate(self.clients)))
+
+    def next_client(self) -> LanguageClient:
+        return next(self._next)
+
+    async def stop(self) -> None:
+        await asyncio.gather(*(stop_client(client) for client in self.clients))
+
+
+async def _settle(aw) -> None:
+    try:
+        await aw
+    except (asyncio.CancelledError, Exception):
+        pass
+
+
 async def stop_client(client: LanguageClient) -> None:
     stop_event = getattr(client, "_stop_event", None)
     if stop_event:
         stop_event.set()
 
     server_proc = getattr(client, "_server", None)
-    if server_proc:
-        stdin = getattr(server_proc, "stdin", None)
-        if stdin:
-            stdin.close()
-            try:
-                await stdin.wait_closed()
-            except Exception:
-                pass
-
-        if server_proc.returncode is None:
-            server_proc.terminate()
-            try:
-                await asyncio.wait_for(server_proc.wait(), timeout=2.0)
-            except asyncio.TimeoutError:
-                server_proc.kill()
-                await server_proc.wait()
-
     async_tasks = getattr(client, "_async_tasks", [])
-    for task in async_tasks:
-        if not task.done():
-            task.cancel()
-    if async_tasks:
-        await asyncio.gather(*async_tasks, return_exceptions=True)
-
-
-async def await_with_timeout(coro, label: str, timeout: float) -> types.CompletionList | types.InitializeResult:
+    try:
+        async with asyncio.timeout(2.0):
+            async with asyncio.TaskGroup() as tg:
+                stdin = getattr(server_proc, "stdin", None)
+                if stdin:
+                    stdin.close()
+                    tg.create_task(_settle(stdin.wait_closed()))
+                for task in async_tasks:
+                    if not task.done():
+                        task.cancel()
+                    tg.create_task(_settle(task))
+                if server_proc and server_proc.returncode is None:
+                    server_proc.terminate()
+                    tg.create_task(server_proc.wait())
+    except TimeoutError:
+        if server_proc and server_proc.returncode is None:
+            server_proc.kill()
+            await server_proc.wait()
+
+
+async def await_with_timeout(
+    coro, label: str, timeout: float
+) -> list[types.CompletionItem] | types.CompletionList | types.InitializeResult:
     try:
         return await asyncio.wait_for(coro, timeout=timeout)
     except asyncio.TimeoutError:
@@ -95,12 +319,11 @@ async def await_with_timeout(coro, label: str, timeout: float) -> types.Completi
         raise
 
 
-async def request_completion(
-    client: LanguageClient,
+def completion_params(
     uri: str,
     position: types.Position,
     trigger_character: str | None = None,
-) -> types.CompletionList:
+) -> types.CompletionParams:
     if trigger_character:
         context = types.CompletionContext(
             trigger_kind=types.CompletionTriggerKind.TriggerCharacter,
@@ -111,18 +334,175 @@ async def request_completion(
             trigger_kind=types.CompletionTriggerKind.Invoked,
         )
 
-    params = types.CompletionParams(
+    return types.CompletionParams(
         text_document=types.TextDocumentIdentifier(uri=uri),
         position=position,
         context=context,
     )
-    return await client.text_document_completion_async(params=params)
+
+
+async def await_initialize(
+    initialize: asyncio.Task,
+    server_proc: asyncio.subprocess.Process | None,
+    timeout: float,
+) -> types.InitializeResult:
+    if server_proc is None:
+        return await await_with_timeout(initialize, "initialize", timeout)
+
+    # Race the handshake against the server exiting so a crash fails straight away
+    # instead of after the full timeout.
+    exited = asyncio.create_task(server_proc.wait())
+    try:
+        done, _ = await asyncio.wait(
+            {initialize, exited}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        exited.cancel()
+
+    if initialize in done:
+        return initialize.result()
+    initialize.cancel()
+    if exited in done:
+        raise RuntimeError(f"server exited with code {server_proc.returncode} during initialize")
+    log(f"[timeout] initialize after {timeout}s")
+    raise asyncio.TimeoutError
+
+
+async def request_completion(
+    client: LanguageClient,
+    uri: str,
+    position: types.Position,
+    trigger_character: str | None = None,
+) -> types.CompletionList:
+    return await client.text_document_completion_async(
+        params=completion_params(uri, position, trigger_character)
+    )
+
+
+class Superseded(Exception):
+    """Raised to a completion caller whose request was replaced by a newer one."""
+
+
+class CompletionDispatcher:
+    """Sends completions so that a newer request for a slot supersedes the older one.
+
+    The superseded caller gets :class:`Superseded` and a ``$/cancelRequest`` is
+    sent, letting the server drop work whose answer nobody will read.
+    """
+
+    def __init__(self) -> None:
+        self._pending: dict[tuple, tuple[LanguageClient, str, asyncio.Future]] = {}
+
+    async def request(
+        self, client: LanguageClient, slot: tuple, params: types.CompletionParams
+    ) -> types.CompletionList:
+        previous = self._pending.pop(slot, None)
+        if previous is not None and not previous[2].done():
+            # Cancel on the connection that carried the request, which may be a
+            # different pooled server than the one receiving the new request.
+            owner, previous_id, previous_future = previous
+            owner.protocol.notify(types.CANCEL_REQUEST, types.CancelParams(id=previous_id))
+            # Forget the id so the late response is dropped instead of resolving
+            # a future whose caller has already been answered.
+            owner.protocol._request_futures.pop(previous_id, None)
+            owner.protocol._result_types.pop(previous_id, None)
+            previous_future.set_exception(Superseded(previous_id))
+
+        msg_id = str(uuid.uuid4())
+        future = client.protocol.send_request_async(types.TEXT_DOCUMENT_COMPLETION, params, msg_id=msg_id)
+        self._pending[slot] = (client, msg_id, future)
+        try:
+            return await future
+        finally:
+            if slot in self._pending and self._pending[slot][2] is future:
+                del self._pending[slot]
+
+
+def _matching_items(items: Sequence[types.CompletionItem], prefix: str) -> list[types.CompletionItem]:
+    # After a separator (`total/c`) the labels only cover the last segment,
+    # while require paths (`foo/b`) match on the whole prefix.
+    word = prefix.rpartition("/")[2]
+    return [item for item in items if item.label.startswith(prefix) or item.label.startswith(word)]
+
+
+class CompletionCache:
+    """Completion results keyed by the identifier being typed.
+
+    A completion started at the same identifier of the same document version is
+    answered from the stored items as long as the new prefix extends the one
+    the server saw, so each further keystroke skips a round-trip. Entries for a
+    document are dropped as soon as a newer version of it is completed.
+    """
+
+    def __init__(self) -> None:
+        self._entries: dict[tuple[str, int, int, int], tuple[str, list[types.CompletionItem]]] = {}
+        self._versions: dict[str, int] = {}
+        self._dispatcher = CompletionDispatcher()
+
+    def invalidate(self, uri: str) -> None:
+        for key in [key for key in self._entries if key[0] == uri]:
+            del self._entries[key]
+        self._versions.pop(uri, None)
+
+    async def complete(
+        self,
+        client: LanguageClient,
+        uri: str,
+        version: int,
+        text: str,
+        position: types.Position,
+        trigger_character: str | None = None,
+    ) -> list[types.CompletionItem]:
+        newlines = _newline_offsets(text)
+        line_start = newlines[position.line - 1] + 1 if position.line else 0
+        match = IDENTIFIER_TAIL.search(text, line_start, line_start + position.character)
+        prefix = match.group(0) if match else ""
+        key = (uri, version, position.line, position.character - len(prefix))
+        if self._versions.get(uri) != version:
+            self.invalidate(uri)
+            self._versions[uri] = version
+
+        entry = self._entries.get(key)
+        if entry is not None and prefix.startswith(entry[0]):
+            return _matching_items(entry[1], prefix)
+
+        # Keystrokes within one identifier share a slot, so a request still in
+        # flight for a shorter prefix is cancelled.
+        result = await self._dispatcher.request(
+            client,
+            (uri, position.line, key[3]),
+            completion_params(uri, position, trigger_character),
+        )
+        if isinstance(result, types.CompletionList):
+            items = result.items
+            cacheable = not result.is_incomplete
+        else:
+            items = list(result or [])
+            cacheable = True
+        # Don't store an answer that arrived after a newer version was seen.
+        if cacheable and self._versions.get(uri) == version:
+            self._entries[key] = (prefix, items)
+        return _matching_items(items, prefix)
+
+
+async def wait_for_server(client: LanguageClient, uri: str) -> None:
+    # The server handles messages in order, so the first answered request
+    # means didOpen has been applied.
+    await await_with_timeout(
+        request_completion(client, uri, types.Position(line=0, character=0)),
+        "completion(ready)",
+        REQUEST_TIMEOUT,
+    )
 
 
 def print_result(title: str, items: list[types.CompletionItem], expected: list[str]) -> None:
-    labels = {item.label for item in items}
-    hits = [label for label in expected if label in labels]
-    misses = [label for label in expected if label not in labels]
+    labels = set()
+    for item in items:
+        labels.add(item.label)
+    hits: list[str] = []
+    misses: list[str] = []
+    for label in expected:
+        (hits if label in labels else misses).append(label)
     log(f"{title}: {len(items)} items")
     if hits:
         log("  hits: " + ", ".join(hits))
@@ -131,113 +511,90 @@ def print_result(title: str, items: list[types.CompletionItem], expected: list[s
 
 
 async def main() -> None:
-    client = LanguageClient("cr-analyzer", "v1")
-    log("starting server...")
-    await client.start_io(
-        "crystal",
-        "run",
-        "-Dpreview_mt",
-        "-Dexecution_context",
-        "src/bin/cra.cr",
-    )
-    log("server started")
-
-    async def _drain_stderr(server_proc: asyncio.subprocess.Process | None) -> None:
-        if server_proc is None or server_proc.stderr is None:
-            return
-        async for line in server_proc.stderr:
-            text = line.decode(errors="replace").rstrip()
-            if "ERROR" in text or "Error" in text or "error" in text:
-                log(f"[server stderr] {text}")
-
-    stderr_task = asyncio.create_task(_drain_stderr(client._server))
-
-    try:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            root = Path(tmpdir)
-            (root / "src" / "foo").mkdir(parents=True, exist_ok=True)
-            (root / "src" / "foo" / "bar.cr").write_text("")
-            (root / "src" / "foo" / "baz.cr").write_text("")
-            sample_path = root / "sample.cr"
-            sample_path.write_text(SAMPLE_CODE)
-
+    async with log_flusher():
+        await run_harness()
+
+
+async def run_harness() -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        require_dir = root / "src" / "foo"
+        require_dir.mkdir(parents=True, exist_ok=True)
+        require_files = [require_dir / "bar.cr", require_dir / "baz.cr"]
+        for path in require_files:
+            path.write_bytes(b"")
+        sample_path = root / "sample.cr"
+        sample_path.write_text(SAMPLE_CODE)
+        sample_uri = sample_path.as_uri()
+        root_uri = root.as_uri()
+
+        pool = ClientPool(POOL_SIZE)
+        initializers: list[asyncio.Task] = []
+        try:
+            size = len(pool.clients)
+            log("starting server..." if size == 1 else f"starting {size} servers...")
+            await pool.start()
+            log("server started")
+
+            # Queue initialize straight away. Over stdio `crystal run` may still be
+            # compiling, and the request waits in the server's stdin until it starts
+            # reading; in pipe mode start_pipe has already waited for the socket.
             log("initializing...")
-            await await_with_timeout(
-                client.initialize_async(
-                    params=types.InitializeParams(
-                        capabilities=types.ClientCapabilities(
-                            workspace=types.WorkspaceClientCapabilities(apply_edit=True)
-                        ),
-                        root_uri=root.as_uri(),
-                    )
+            initialize_params = types.InitializeParams(
+                capabilities=types.ClientCapabilities(
+                    workspace=types.WorkspaceClientCapabilities(apply_edit=True)
                 ),
-                "initialize",
-                INIT_TIMEOUT,
+                root_uri=root_uri,
+            )
+            for client in pool.clients:
+                initializers.append(asyncio.create_task(client.initialize_async(params=initialize_params)))
+
+            await asyncio.gather(
+                *(
+                    await_initialize(initialize, client._server, INIT_TIMEOUT)
+                    for initialize, client in zip(initializers, pool.clients)
+                )
             )
-            client.initialized(types.InitializedParams())
+            for client in pool.clients:
+                client.initialized(types.InitializedParams())
             log("initialized")
 
-            client.text_document_did_open(
-                types.DidOpenTextDocumentParams(
-                    text_document=types.TextDocumentItem(
-                        uri=sample_path.as_uri(),
-                        language_id="crystal",
-                        version=1,
-                        text=SAMPLE_CODE,
+            for client in pool.clients:
+                client.text_document_did_open(
+                    types.DidOpenTextDocumentParams(
+                        text_document=types.TextDocumentItem(
+                            uri=sample_uri,
+                            language_id="crystal",
+                            version=1,
+                            text=SAMPLE_CODE,
+                        )
                     )
                 )
-            )
             log("didOpen sent")
 
-            await asyncio.sleep(0.2)
+            await asyncio.gather(*(wait_for_server(client, sample_uri) for client in pool.clients))
 
-            method_pos = position_for(SAMPLE_CODE, "greeter.gr", offset=len("greeter.gr"))
-            method_items = (
-                await await_with_timeout(
-                    request_completion(client, sample_path.as_uri(), method_pos, "."),
-                    "completion(method)",
-                    REQUEST_TIMEOUT,
-                )
-            ).items
-            print_result("method completion", method_items, ["greet", "grab"])
-
-            ivar_pos = position_for(SAMPLE_CODE, "@ba", offset=len("@ba"))
-            ivar_items = (
-                await await_with_timeout(
-                    request_completion(client, sample_path.as_uri(), ivar_pos, "@"),
-                    "completion(ivar)",
-                    REQUEST_TIMEOUT,
-                )
-            ).items
-            print_result("ivar completion", ivar_items, ["@bar", "@baz"])
-
-            keyword_pos = position_for(SAMPLE_CODE, "ret", offset=len("ret"))
-            keyword_items = (
-                await await_with_timeout(
-                    request_completion(client, sample_path.as_uri(), keyword_pos),
-                    "completion(keyword)",
-                    REQUEST_TIMEOUT,
-                )
-            ).items
-            print_result("keyword completion", keyword_items, ["return"])
-
-            require_pos = position_for(SAMPLE_CODE, "foo/ba", offset=len("foo/ba"))
-            require_items = (
-                await await_with_timeout(
-                    request_completion(client, sample_path.as_uri(), require_pos),
-                    "completion(require)",
-                    REQUEST_TIMEOUT,
-                )
-            ).items
-            print_result("require completion", require_items, ["foo/bar", "foo/baz"])
-    finally:
-        stderr_task.cancel()
-        try:
-            await stderr_task
-        except asyncio.CancelledError:
-            pass
-        await stop_client(client)
+            completions = CompletionCache()
+            results = await asyncio.gather(
+                *[
+                    await_with_timeout(
+                        completions.complete(
+                            pool.next_client(), sample_uri, 1, SAMPLE_CODE, POSITIONS[name], trigger
+                        ),
+                        f"completion({name})",
+                        REQUEST_TIMEOUT,
+                    )
+                    for name, trigger, _ in PROBES
+                ]
+            )
+            for (name, _, expected), items in zip(PROBES, results):
+                print_result(f"{name} completion", items, expected)
+        finally:
+            for task in initializers:
+                task.cancel()
+            await pool.stop()
 
 
 if __name__ == "__main__":
+    use_orjson()
     asyncio.run(main())
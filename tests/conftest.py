@@ -1,18 +1,29 @@
 import asyncio
+import collections
 import os
+import subprocess
 from pathlib import Path
 
+import pytest
 import pytest_asyncio
 from lsprotocol.types import (
     ClientCapabilities,
     InitializeParams,
     CompletionClientCapabilities,
+    DidCloseTextDocumentParams,
+    DidOpenTextDocumentParams,
     TextDocumentClientCapabilities,
+    TextDocumentIdentifier,
 )
 from pygls.lsp.client import LanguageClient
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
-CRYSTAL_SRC = PROJECT_ROOT / "src" / "cr-analyzer.cr"
+# Same entry point main.py runs; src/cr-analyzer.cr only defines the server.
+CRYSTAL_SRC = PROJECT_ROOT / "src" / "bin" / "cra.cr"
+ROOT_URI = f"file://{PROJECT_ROOT}"
+SERVER_BINARY = PROJECT_ROOT / ".cache" / "cra"
+# Records which entry point the cached binary was built from.
+SERVER_BINARY_TARGET = SERVER_BINARY.with_suffix(".target")
 
 
 def _server_env() -> dict[str, str]:
@@ -22,52 +33,120 @@ def _server_env() -> dict[str, str]:
     }
 
 
-@pytest_asyncio.fixture(scope="function")
-async def lsp_client():
+def _binary_is_stale() -> bool:
+    if not SERVER_BINARY.exists() or not SERVER_BINARY_TARGET.exists():
+        return True
+    if SERVER_BINARY_TARGET.read_text() != str(CRYSTAL_SRC):
+        return True
+    built_at = SERVER_BINARY.stat().st_mtime
+    # The entry point pulls in the rest of src/ through requires.
+    sources = [CRYSTAL_SRC, *PROJECT_ROOT.joinpath("src").rglob("*.cr"), PROJECT_ROOT / "shard.lock"]
+    return any(path.stat().st_mtime > built_at for path in sources if path.exists())
+
+
+@pytest.fixture(scope="session")
+def crystal_binary() -> Path:
+    # Compile once and reuse the binary across sessions until a source changes,
+    # instead of paying for `crystal run` every time the suite starts.
+    if _binary_is_stale():
+        print("[fixture] building server binary")
+        SERVER_BINARY.parent.mkdir(parents=True, exist_ok=True)
+        subprocess.run(
+            [
+                "crystal",
+                "build",
+                "-Dpreview_mt",
+                "-Dexecution_context",
+                str(CRYSTAL_SRC),
+                "-o",
+                str(SERVER_BINARY),
+            ],
+            check=True,
+            cwd=str(PROJECT_ROOT),
+        )
+        SERVER_BINARY_TARGET.write_text(str(CRYSTAL_SRC))
+    return SERVER_BINARY
+
+
+class SessionClient(LanguageClient):
+    """LanguageClient that remembers which documents a test left open."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.open_documents: set[str] = set()
+
+    def text_document_did_open(self, params: DidOpenTextDocumentParams) -> None:
+        self.open_documents.add(params.text_document.uri)
+        super().text_document_did_open(params)
+
+    def text_document_did_close(self, params: DidCloseTextDocumentParams) -> None:
+        self.open_documents.discard(params.text_document.uri)
+        super().text_document_did_close(params)
+
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def lsp_session(crystal_binary: Path):
     print("[fixture] starting server")
-    client = LanguageClient("cr-analyzer", "v0")
+    client = SessionClient("cr-analyzer", "v0")
     await client.start_io(
-        "crystal",
-        "run",
-        "-Dpreview_mt",
-        "-Dexecution_context",
-        str(CRYSTAL_SRC),
+        str(crystal_binary),
         env=_server_env(),
         cwd=str(PROJECT_ROOT),
     )
     server = getattr(client, "_server", None)
 
+    # The pump owns the stderr stream and keeps only the last lines; they are
+    # printed on the error path and at teardown.
+    recent_stderr: collections.deque[bytes] = collections.deque(maxlen=200)
+
+    def _stderr_tail() -> str:
+        return b"\n".join(recent_stderr).decode(errors="replace")
+
     stderr_task = None
     if server and server.stderr:
 
         async def _pump_stderr():
-            while True:
-                line = await server.stderr.readline()
-                if not line:
-                    break
-                print("[server stderr]", line.decode().rstrip())
+            pending = b""
+            while chunk := await server.stderr.read(65536):
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                recent_stderr.extend(lines)
+            if pending:
+                recent_stderr.append(pending)
 
         stderr_task = asyncio.create_task(_pump_stderr())
     print("[fixture] server process started")
 
     try:
-        await client.initialize_async(
-            params=InitializeParams(
-                capabilities=ClientCapabilities(
-                    text_document=TextDocumentClientCapabilities(
-                        completion=CompletionClientCapabilities()
-                    )
-                ),
-                root_uri=f"file://{PROJECT_ROOT}",
+        initialize = asyncio.create_task(
+            client.initialize_async(
+                params=InitializeParams(
+                    capabilities=ClientCapabilities(
+                        text_document=TextDocumentClientCapabilities(
+                            completion=CompletionClientCapabilities()
+                        )
+                    ),
+                    root_uri=ROOT_URI,
+                )
             )
         )
+        if server:
+            # Fail as soon as the server dies instead of waiting on the handshake.
+            exited = asyncio.create_task(server.wait())
+            await asyncio.wait({initialize, exited}, return_when=asyncio.FIRST_COMPLETED)
+            exited.cancel()
+            if not initialize.done():
+                initialize.cancel()
+                raise RuntimeError("server exited during initialize")
+        await initialize
         print("[fixture] initialize completed")
     except RuntimeError:
-        server = getattr(client, "_server", None)
-        if server and server.stderr:
-            err = await server.stderr.read()
-            print("[fixture] init stderr:\n", err.decode())
-            raise RuntimeError(err.decode() or "server exited during initialize")
+        if stderr_task:
+            # Give the pump a moment to collect what the dying server printed.
+            await asyncio.wait({stderr_task}, timeout=1)
+            err = _stderr_tail()
+            print("[fixture] init stderr:\n", err)
+            raise RuntimeError(err or "server exited during initialize")
         raise
 
     try:
@@ -83,12 +162,25 @@ async def lsp_client():
                 print("[fixture] server wait timed out; killing")
                 server.kill()
                 await server.wait()
-
-            if server.returncode and server.stderr:
-                err = await server.stderr.read()
-                if err:
-                    print("[fixture] server stderr during teardown:\n", err.decode())
         if stderr_task:
             await stderr_task
+        if recent_stderr:
+            print("[fixture] server stderr (last lines):\n", _stderr_tail())
         # Ensure event loop sees completion
         await asyncio.sleep(0)
+
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def lsp_client(lsp_session: SessionClient):
+    # The server is shared by the whole session; a crash in an earlier test
+    # should fail loudly here instead of timing out on the next request.
+    server = getattr(lsp_session, "_server", None)
+    assert server is None or server.returncode is None, "server process exited"
+
+    try:
+        yield lsp_session
+    finally:
+        for uri in list(lsp_session.open_documents):
+            lsp_session.text_document_did_close(
+                DidCloseTextDocumentParams(text_document=TextDocumentIdentifier(uri=uri))
+            )
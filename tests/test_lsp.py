@@ -10,7 +10,7 @@ from lsprotocol.types import (
 from pygls.lsp.client import LanguageClient
 
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_completion_e2e(lsp_client: LanguageClient):
     root_uri = f"file://{Path(__file__).resolve().parents[1]}"
     doc_uri = f"{root_uri}/src/cra/types.cr"